@@ -6,10 +6,13 @@ Unofficial Spacedesk client for Linux using PyQt6 and GStreamer
 # Force X11 backend, as our video rendering depends on it.
 import os
 os.environ["GDK_BACKEND"] = "x11"
+# GStreamer GL would pick Wayland first on a Wayland session and could not embed
+# into our X11 window. EGL is needed for glupload to import decoded frames as DMABuf
+os.environ["GST_GL_WINDOW"] = "x11"
+os.environ["GST_GL_PLATFORM"] = "egl"
 
 import logging
 import argparse
-import queue
 
 import gi
 
@@ -79,13 +82,10 @@ class GtkWindow:
 class Application:
     def __init__(self, args):
         self.args = args
-        self.raw_frames_queue = queue.Queue(maxsize=50)
 
         self.window = GtkWindow(int(self.args.width / 2), int(self.args.height / 2))
         xid = self.window.get_draw_id()
-        self.decoder = VideoDecoder(
-            xid, self.raw_frames_queue, self.args.width, self.args.height
-        )
+        self.decoder = VideoDecoder(xid, self.args.width, self.args.height)
         self.streamer = Streamer(
             self.decoder.push_data,
             self.args.host,
@@ -148,6 +148,19 @@ def parse_resolution(resolution_str):
         )
 
 
+def parse_quality(quality_str):
+    try:
+        quality = int(quality_str)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"Quality must be an integer: {e}")
+
+    if not 1 <= quality <= 100:
+        raise argparse.ArgumentTypeError(
+            f"Quality must be between 1 and 100, got {quality}"
+        )
+    return quality
+
+
 def parse_arguments():
     default_width, default_height = get_screen_dimensions()
     default_resolution = f"{default_width}x{default_height}"
@@ -186,9 +199,8 @@ def parse_arguments():
     parser.add_argument(
         "-q",
         "--quality",
-        type=int,
+        type=parse_quality,
         default=90,
-        choices=range(1, 101),
         metavar="[1-100]",
         help="Video quality (1-100)",
     )
@@ -1,8 +1,10 @@
 import enum
+import io
 import logging
 import socket
 import select
 import hashlib
+import struct
 import uuid
 import threading
 
@@ -12,6 +14,32 @@ def create_uuid_from_string(val: str):
     return uuid.UUID(hex=hex_string)
 
 
+# Identification string: "{UUID based on hostname} {hostname}" keep it stable across runs
+# so the virtual screen is placed in the same position in the display arrangement on the host side
+_HOSTNAME = socket.gethostname()
+_IDENTIFICATION_BYTES = (
+    f"{{{create_uuid_from_string(_HOSTNAME).hex}}} {_HOSTNAME}".encode("utf-16-le")
+)
+
+
+_UINT32 = struct.Struct("<I")
+# Common start of every packet header: packet type, payload size
+_HEADER_PREFIX = struct.Struct("<II")
+
+# Layout of the ConnectionStart header, as observed in Wireshark captures of the official clients
+_CONNECTION_START_HEADER = struct.Struct(
+    "<"
+    "II"  # Packet type, payload size
+    "6I"  # Values copied from intercepted packet
+    "I"  # Quality
+    "HHI"  # Compression type, unknown, unknown
+    "HHI"  # Framerate, unknown, operating system
+    "I32x"  # Width, then 8 * 4 bytes of empty space
+    "I32x"  # Height, then 8 * 4 bytes of empty space
+    "I"  # License type
+)
+
+
 class PacketType(enum.IntEnum):
     CONNECTION_START = 0
     PING = 1
@@ -21,20 +49,22 @@ class PacketType(enum.IntEnum):
 
 
 def recv_until_timeout(
-    sock: socket.socket, bufsize: int = 4096, timeout: float = 500
+    sock: socket.socket, bufsize: int = 65536, timeout: float = 0.5
 ) -> bytes:
-    chunks = bytearray()
+    scratch = bytearray(bufsize)
+    view = memoryview(scratch)
+    chunks = io.BytesIO()
     sock.settimeout(timeout)
     try:
         while True:
-            data = sock.recv(bufsize)
-            if not data:  # remote closed connection
+            nbytes = sock.recv_into(view)
+            if not nbytes:  # remote closed connection
                 break
-            chunks.extend(data)
+            chunks.write(view[:nbytes])
     except socket.timeout:
         # no more data for now
         pass
-    return bytes(chunks)
+    return chunks.getvalue()
 
 
 class Packet:
@@ -47,103 +77,74 @@ class Packet:
         return bytes(self.msg)
 
 
-class VideoDataAckPacket(Packet):
-    def __init__(self):
-        super().__init__()
-        self.msg[0:4] = (PacketType.VIDEO_DATA_ACK).to_bytes(4, byteorder="little")
+# Constant packets, sent as-is without building a Packet each time
+_ACK_BYTES = _UINT32.pack(PacketType.VIDEO_DATA_ACK) + bytes(Packet.PACKET_SIZE - 4)
+_DISCONNECT_BYTES = _UINT32.pack(PacketType.DISCONNECT) + bytes(Packet.PACKET_SIZE - 4)
 
 
-class DisconnectPacket(Packet):
-    def __init__(self):
-        super().__init__()
-        self.msg[0:4] = (PacketType.DISCONNECT).to_bytes(4, byteorder="little")
-
 class PongPacket(Packet):
     def __init__(self):
         super().__init__()
-        self.msg[0:4] = (PacketType.PING).to_bytes(4, byteorder="little")
+        _UINT32.pack_into(self.msg, 0, PacketType.PING)
         # Ping response? Ping packet from server has a "1" here.
-        self.msg[12:16] = (2).to_bytes(4, byteorder="little")
+        _UINT32.pack_into(self.msg, 12, 2)
 
 class ConnectionStartPacket(Packet):
     PAYLOAD_SIZE = 334
 
     def __init__(self, width, height, quality):
-        super().__init__()
-        # Build the first packet according to the observed structure in Wireshark captures of the official Windows and Android clients
-        self.msg[0:4] = (PacketType.CONNECTION_START).to_bytes(4, byteorder="little")
-
-        # Payload size. Don't know why 334 even though the payload is only identification string
-        self.msg[4:8] = (self.PAYLOAD_SIZE).to_bytes(4, byteorder="little")
-
-        # Values copied from intercepted packet
-        self.msg[8:12] = (4).to_bytes(4, byteorder="little")
-        self.msg[12:16] = (8).to_bytes(4, byteorder="little")
-        self.msg[16:20] = (0).to_bytes(4, byteorder="little")
-        self.msg[20:24] = (1).to_bytes(4, byteorder="little")
-        self.msg[24:28] = (3).to_bytes(4, byteorder="little")
-        self.msg[28:32] = (2).to_bytes(4, byteorder="little")
-
-        # Quality settings 0 - 100
-        self.msg[32:36] = (quality).to_bytes(4, byteorder="little")
-        self.msg[36:38] = (4).to_bytes(2, byteorder="little")  # Compression Type = H264
-        self.msg[38:40] = (1).to_bytes(2, byteorder="little")
-        self.msg[40:44] = (0).to_bytes(4, byteorder="little")
-        # Framerate? I have not seen any difference
-        self.msg[44:46] = (60).to_bytes(2, byteorder="little")
-        self.msg[46:48] = (4).to_bytes(2, byteorder="little")
-        # Depends on operating system => 1 for Windows?
-        self.msg[48:52] = (1).to_bytes(4, byteorder="little")
-
-        # Virtual display resolution. Empty space = More than 1 screen?
-        self.msg[52:56] = (width).to_bytes(4, byteorder="little")
-        # 8 * 4 bytes of empty space
-
-        self.msg[88:92] = (height).to_bytes(4, byteorder="little")
-        # 8 * 4 bytes of empty space
-
-        # License Type. 0 = Free, 1 or 2 = Non-Commercial, 3 = Commercial. Don't know if this is actually used for anything.
-        self.msg[124:128] = (0).to_bytes(4, byteorder="little")
-
-        self.payload = bytearray(334)
-        # Identification string: "{UUID based on hostname} {hostname}" keep it stable across runs
-        # so the virtual screen is placed in the same position in the display arrangement on the host side
-        hostname = socket.gethostname()
-        identification_str = f"{{{create_uuid_from_string(hostname).hex}}} {hostname}"
-        for i in range(len(identification_str)):
-            self.payload[i * 2 : (i + 1) * 2] = ord(identification_str[i]).to_bytes(
-                2, byteorder="little"
-            )
+        # Header and payload are written in place into a single wire buffer
+        self._wire = bytearray(self.PACKET_SIZE + self.PAYLOAD_SIZE)
+        self.msg = memoryview(self._wire)[: self.PACKET_SIZE]
+        self.payload = memoryview(self._wire)[self.PACKET_SIZE :]
 
-    def get_bytes(self) -> bytes:
-        msg_with_payload = bytearray(self.PACKET_SIZE + self.PAYLOAD_SIZE)
-        msg_with_payload[0 : self.PACKET_SIZE] = bytes(self.msg)
-        msg_with_payload[self.PACKET_SIZE : self.PACKET_SIZE + self.PAYLOAD_SIZE] = (
-            bytes(self.payload)
+        # Build the first packet according to the observed structure in Wireshark captures of the official Windows and Android clients
+        _CONNECTION_START_HEADER.pack_into(
+            self.msg,
+            0,
+            PacketType.CONNECTION_START,
+            # Payload size. Don't know why 334 even though the payload is only identification string
+            self.PAYLOAD_SIZE,
+            # Values copied from intercepted packet
+            4,
+            8,
+            0,
+            1,
+            3,
+            2,
+            # Quality settings 0 - 100
+            quality,
+            4,  # Compression Type = H264
+            1,
+            0,
+            # Framerate? I have not seen any difference
+            60,
+            4,
+            # Depends on operating system => 1 for Windows?
+            1,
+            # Virtual display resolution. Empty space = More than 1 screen?
+            width,
+            height,
+            # License Type. 0 = Free, 1 or 2 = Non-Commercial, 3 = Commercial. Don't know if this is actually used for anything.
+            0,
         )
 
-        return bytes(msg_with_payload)
-
-
-def get_packet_type(data: bytes) -> PacketType | int:
-    if len(data) < 4:
-        raise ValueError("data too short to determine packet type")
-    val = int.from_bytes(data[0:4], byteorder="little")
-    try:
-        return PacketType(val)
-    except ValueError:
-        # Unknown packet type; return the raw integer so caller can handle it
-        return val
+        self.payload[: len(_IDENTIFICATION_BYTES)] = _IDENTIFICATION_BYTES
 
+        self._wire_bytes = bytes(self._wire)
 
-def get_payload_size(data: bytes) -> int:
-    if len(data) < 8:
-        raise ValueError("data too short to determine payload size")
-    return int.from_bytes(data[4:8], byteorder="little")
+    def get_bytes(self) -> bytes:
+        return self._wire_bytes
 
 
 class Streamer(threading.Thread):
     DEFAULT_SPACEDESK_PORT = 28252
+    # How often the receive loop wakes up to check if it should keep running
+    RECEIVE_TIMEOUT = 0.1
+    # How long the final flush and Disconnect packet may take when stopping
+    DISCONNECT_TIMEOUT = 5
+    # Unsent bytes we accept to hold before considering the server gone
+    MAX_PENDING_SEND = 64 * 1024
 
     def __init__(
         self,
@@ -164,29 +165,106 @@ class Streamer(threading.Thread):
 
         self.running = True
 
+        # Reused for every received packet header
+        self._header = bytearray(Packet.PACKET_SIZE)
+        self._header_view = memoryview(self._header)
+        # Outgoing bytes that did not fit in the kernel send buffer yet
+        self._pending_send = bytearray()
+        # Created once connected, see run()
+        self._send_sock = None
+
+        # Packet type -> handler, called with the payload size from the header
+        self._handlers = {
+            PacketType.PING: self.handle_ping,
+            PacketType.CONNECTION_START: self.handle_connection_start,
+            PacketType.VIDEO_DATA: self.handle_video_data,
+        }
+
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Acks are tiny, do not let Nagle hold them back
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # SO_RCVBUF is deliberately left alone: setting it disables Linux receive
+        # autotuning (which grows up to tcp_rmem max) and is capped by rmem_max anyway
         self.sock.settimeout(5)
 
-    def wait_for_data(self, timeout=0.1) -> bool:
-        # Wait for the socket to be readable (data available) or timeout after 5 seconds
-        rlist, _, _ = select.select([self.sock], [], [], timeout)
-        return bool(rlist)
+    def receive_into(self, view: memoryview):
+        # Fill the whole view, retrying on timeouts as long as we are running
+        received = 0
+        size = len(view)
+        while received < size:
+            try:
+                nbytes = self.sock.recv_into(view[received:])
+            except socket.timeout:
+                if not self.running:
+                    raise
+                continue
+            if not nbytes:
+                raise ConnectionError("Socket closed before receiving expected data")
+            received += nbytes
 
     def receive_size(self, size) -> bytes:
-        received = bytearray()
-        while len(received) < size:
-            self.wait_for_data()
-            chunk = self.sock.recv(size - len(received))
-            if not chunk:
-                raise ConnectionError("Socket closed before receiving expected data")
-            received.extend(chunk)
+        received = bytearray(size)
+        self.receive_into(memoryview(received))
         return bytes(received)
 
+    def send_nonblocking(self, data: bytes):
+        # Never stall the receive path on a full send buffer: keep what did not fit,
+        # behind anything already pending so the stream stays in order
+        if not self._pending_send:
+            try:
+                sent = self._send_sock.send(data)
+            except BlockingIOError:
+                sent = 0
+            data = data[sent:]
+        if len(self._pending_send) + len(data) > self.MAX_PENDING_SEND:
+            raise ConnectionError("Server stopped reading, too much unsent data")
+        self._pending_send.extend(data)
+
+    def flush_pending_send(self):
+        try:
+            sent = self._send_sock.send(self._pending_send)
+        except BlockingIOError:
+            return
+        del self._pending_send[:sent]
+
+    def wait_for_data(self) -> bool:
+        # Something is waiting to be sent: wake up as soon as the socket is writable
+        # to flush it, not only once the next packet arrives or the timeout expires
+        readable, writable, _ = select.select(
+            [self.sock], [self._send_sock], [], self.RECEIVE_TIMEOUT
+        )
+        if writable:
+            self.flush_pending_send()
+        return bool(readable)
+
+    def handle_ping(self, _):
+        logging.info("Received Ping packet, sending Ping response")
+        pong_packet = PongPacket()
+        self.send_nonblocking(pong_packet.get_bytes())
+
+    def handle_connection_start(self, _):
+        logging.info("Received CONNECTION_START packet, ignoring")
+
+    def handle_video_data(self, payload_size):
+        logging.debug(f"Received VIDEO_DATA. Payload size: {payload_size}")
+        full_payload = self.receive_size(payload_size)
+        self.push_data_callback(full_payload)
+
+        # Send Framebuffer Ack packet
+        self.send_nonblocking(_ACK_BYTES)
+
+    def send_disconnect(self):
+        logging.info("Sending Disconnect packet")
+        # Queue behind any partially sent packet, so the server's 128-byte framing stays
+        # intact. The receive timeout is too short to flush a backlog, use a longer one
+        self.sock.settimeout(self.DISCONNECT_TIMEOUT)
+        self.sock.sendall(self._pending_send + _DISCONNECT_BYTES)
+        self._pending_send.clear()
+
     def stop(self):
+        # The streamer thread sends the Disconnect packet once its loop exits
         self.running = False
-        logging.info("Streamer stopping, sending Disconnect packet")
-        disconnect_packet = DisconnectPacket()
-        self.sock.sendall(disconnect_packet.get_bytes())
+        logging.info("Streamer stopping")
 
     def run(self):
         logging.info(
@@ -202,39 +280,48 @@ class Streamer(threading.Thread):
         self.sock.sendall(
             ConnectionStartPacket(self.width, self.height, self.quality).get_bytes()
         )
+        self.sock.settimeout(self.RECEIVE_TIMEOUT)
+        # With a timeout set, CPython polls for writability before each send, even with
+        # MSG_DONTWAIT. Send through a duplicate with no timeout so sends never wait
+        self._send_sock = self.sock.dup()
+        self._send_sock.setblocking(False)
+
+        try:
+            self.receive_loop()
+        except socket.timeout:
+            # Stopped in the middle of a packet
+            if self.running:
+                raise
+        finally:
+            self._send_sock.close()
+
+        self.send_disconnect()
 
+    def receive_loop(self):
         while self.running:
-            if not self.wait_for_data():
+            if self._pending_send and not self.wait_for_data():
+                # Nothing to read yet, check if we should keep running
+                continue
+            try:
+                nbytes = self.sock.recv_into(self._header_view)
+            except socket.timeout:
                 # No data received within timeout, check if we should keep running
                 continue
-            if not self.running:
-                break
-
-            received = self.sock.recv(Packet.PACKET_SIZE)
-            if not received:
+            if not nbytes:
                 logging.error(
                     "Error receiving packet. Should not happen in normal network conditions. Happens when TCP stream is interrupted"
                 )
                 raise Exception("Network error")
+            self.receive_into(self._header_view[nbytes:])
 
-            received_packet_type = get_packet_type(received)
-
-            if received_packet_type == PacketType.PING:
-                logging.info("Received Ping packet, sending Ping response")
-                pong_packet = PongPacket()
-                self.sock.sendall(pong_packet.get_bytes())
-            elif received_packet_type == PacketType.CONNECTION_START:
-                logging.info("Received CONNECTION_START packet, ignoring")
-            elif received_packet_type == PacketType.VIDEO_DATA:
-                payload_size = get_payload_size(received)
-                logging.debug(f"Received VIDEO_DATA. Payload size: {payload_size}")
-                full_payload = self.receive_size(payload_size)
-                self.push_data_callback(full_payload)
-
-                # Send Framebuffer Ack packet
-                ack_packet = VideoDataAckPacket()
-                self.sock.sendall(ack_packet.get_bytes())
-            else:
+            received_packet_type, payload_size = _HEADER_PREFIX.unpack_from(
+                self._header
+            )
+
+            handler = self._handlers.get(received_packet_type)
+            if handler is None:
                 logging.info(
                     f"Received unhandled packet type: {received_packet_type}, ignoring"
                 )
+            else:
+                handler(payload_size)
@@ -1,46 +1,109 @@
 import logging
-
+import platform
 
 import gi
 
 gi.require_version("Gst", "1.0")
+gi.require_version("GstApp", "1.0")
 gi.require_version("GstVideo", "1.0")
 gi.require_version("Gdk", "3.0")
 from gi.repository import Gst
+from gi.repository import GstApp  # Direct AppSrc methods instead of action signals
 from gi.repository import (
     GstVideo,
-)  # Seems useless, but if not present xvimagesink opens in another window
+)  # Seems useless, but if not present the video sink opens in another window
 
 
 class VideoDecoder:
-    def __init__(
-        self, x_window_id, raw_frames_queue, width=1920, height=1080, framerate=60
-    ):
+    # Pooled buffers are sized for a typical frame, bigger ones are wrapped on the fly
+    POOL_BUFFER_SIZE = 1024 * 1024
+    POOL_MIN_BUFFERS = 4
+    POOL_MAX_BUFFERS = 8
+    # H.264 decoders to try, in order of preference: hardware first, software last.
+    # openh264dec is only a last resort for systems without gstreamer1.0-libav
+    H264_DECODERS = (
+        "nvh264dec",
+        "vah264dec",
+        "vaapih264dec",
+        "v4l2h264dec",
+        "avdec_h264",
+        "openh264dec",
+    )
+    # ARM boards expose their codec block through V4L2, try it first there
+    ARM_MACHINES = ("aarch64", "armv7l", "armv8l")
+    ARM_H264_DECODERS = ("v4l2h264dec",) + tuple(
+        d for d in H264_DECODERS if d != "v4l2h264dec"
+    )
+
+    def __init__(self, x_window_id, width=1920, height=1080, framerate=60):
         self.x_window_id = x_window_id
-        self.raw_frames_queue = raw_frames_queue
         self.width = width
         self.height = height
         self.framerate = framerate
 
         Gst.init(None)
 
+        if platform.machine() in self.ARM_MACHINES:
+            self.h264_decoders = self.ARM_H264_DECODERS
+        else:
+            self.h264_decoders = self.H264_DECODERS
+
         self.pipeline = None
         self.appsrc = None
+        self.buffer_pool = None
+        self.acquire_params = None
+
+    def create_pipeline(self, decoder):
+        pipeline_string = (
+            "appsrc name=src format=time is-live=true do-timestamp=false "
+            "min-latency=0 max-latency=0 "
+            # No queue element: appsrc buffers on its own streaming thread, bounded to
+            # a couple of frames with block=True (see build_pipeline)
+            "! h264parse config-interval=-1 "
+            f"! {decoder} name=decoder "
+            # glimagesink uploads the decoded VA surfaces as DMABuf when possible
+            # and does the YUV->RGB conversion in a shader, so frames stay on the GPU
+            "! glimagesink name=sink sync=false qos=false"
+        )
+        return Gst.parse_launch(pipeline_string)
+
+    def find_working_decoder(self):
+        # A decoder can be installed but unusable (no device, broken driver): only
+        # keep the first one that actually reaches READY on its own, so a display or
+        # GL problem in the sink is not mistaken for a decoder failure
+        for decoder in self.h264_decoders:
+            factory = Gst.ElementFactory.find(decoder)
+            if factory is None:
+                logging.debug(f"H.264 decoder {decoder} not installed")
+                continue
+
+            element = factory.create(None)
+            if element is None:
+                logging.warning(f"H.264 decoder {decoder} could not be created")
+                continue
+            ready = element.set_state(Gst.State.READY) != Gst.StateChangeReturn.FAILURE
+            element.set_state(Gst.State.NULL)
+            if not ready:
+                logging.warning(f"H.264 decoder {decoder} failed to start, trying next")
+                continue
+
+            logging.info(f"Using H.264 decoder {decoder}")
+            return decoder
+
+        raise RuntimeError(
+            f"No working H.264 decoder found, tried: {', '.join(self.h264_decoders)}"
+        )
 
     def build_pipeline(self):
         try:
-            pipeline_string = (
-                "appsrc name=src format=time is-live=true do-timestamp=false "
-                "min-latency=0 max-latency=0 "
-                "! queue max-size-buffers=1 max-size-time=0 max-size-bytes=0 leaky=downstream "
-                "! h264parse config-interval=-1 "
-                "! vah264dec "
-                "! xvimagesink name=sink sync=false qos=false"
-            )
-
-            self.pipeline = Gst.parse_launch(pipeline_string)
+            self.pipeline = self.create_pipeline(self.find_working_decoder())
             self.pipeline.set_property("latency", 0)
 
+            # Drop frames damaged by missing data rather than displaying them, when the decoder supports it
+            decoder = self.pipeline.get_by_name("decoder")
+            if decoder.find_property("output-corrupt") is not None:
+                decoder.set_property("output-corrupt", False)
+
             # Configure appsrc for minimum latency
             self.appsrc = self.pipeline.get_by_name("src")
             self.appsrc.set_property("format", Gst.Format.TIME)
@@ -49,8 +112,18 @@ class VideoDecoder:
             self.appsrc.set_property("do-timestamp", False)
             self.appsrc.set_property("min-latency", 0)
             self.appsrc.set_property("max-latency", 0)
-            self.appsrc.set_property("block", False)
-            self.appsrc.set_property("max-bytes", 1024 * 1024)  # Small buffer
+            # Bound the internal queue: once it is full, push_data blocks the Streamer,
+            # which delays the ack and so throttles the server. Without block, appsrc
+            # would only emit enough-data and keep queuing
+            self.appsrc.set_property("block", True)
+            if self.appsrc.find_property("max-buffers") is not None:
+                # Bound in frames (GStreamer 1.20+): a byte limit holds many small
+                # P-frames, each one adding a frame of latency
+                self.appsrc.set_property("max-buffers", 2)
+                self.appsrc.set_property("max-bytes", 0)
+            else:
+                # About one keyframe, so at most a frame or two waits in the queue
+                self.appsrc.set_property("max-bytes", 256 * 1024)
 
             # Set caps
             caps = Gst.Caps.from_string(
@@ -60,33 +133,64 @@ class VideoDecoder:
             )
             self.appsrc.set_property("caps", caps)
 
-            # Bus messages
+            # Reuse input buffers instead of allocating a new one for every packet.
+            # The pool is bounded; when it is exhausted get_buffer wraps the data instead
+            # of waiting for a buffer to come back
+            self.buffer_pool = Gst.BufferPool.new()
+            config = self.buffer_pool.get_config()
+            Gst.BufferPool.config_set_params(
+                config,
+                caps,
+                self.POOL_BUFFER_SIZE,
+                self.POOL_MIN_BUFFERS,
+                self.POOL_MAX_BUFFERS,
+            )
+            self.buffer_pool.set_config(config)
+            self.buffer_pool.set_active(True)
+            self.acquire_params = Gst.BufferPoolAcquireParams()
+            self.acquire_params.flags = Gst.BufferPoolAcquireFlags.DONTWAIT
+
+            # Bus messages: handle the few we care about from the posting thread and
+            # drop everything else, instead of dispatching each one through the main loop
             bus = self.pipeline.get_bus()
-            bus.add_signal_watch()
-            bus.enable_sync_message_emission()
-            bus.connect("sync-message::element", self.on_sync_message)
-            bus.connect("message", self.on_bus_message)
+            bus.set_sync_handler(self.on_sync_message)
 
             logging.info("Pipeline built successfully")
         except Exception as e:
             logging.error(f"Failed to build pipeline: {e}")
             raise e
 
-    def on_sync_message(self, _, msg):
-        if msg.get_structure().get_name() == "prepare-window-handle":
-            # Tell GStreamer to draw inside our widget
-            msg.src.set_window_handle(self.x_window_id)
+    def on_sync_message(self, bus, msg, *_user_data):
+        if msg.type == Gst.MessageType.ELEMENT:
+            if msg.get_structure().get_name() == "prepare-window-handle":
+                # Tell GStreamer to draw inside our widget
+                msg.src.set_window_handle(self.x_window_id)
+        elif msg.type in (Gst.MessageType.ERROR, Gst.MessageType.EOS):
+            self.on_bus_message(bus, msg)
+        return Gst.BusSyncReply.DROP
 
     def on_bus_message(self, _, message):
         if message.type == Gst.MessageType.ERROR:
             err, debug = message.parse_error()
             logging.error(f"GStreamer error: {err}, {debug}")
             self.running = False
+        elif message.type == Gst.MessageType.EOS:
+            logging.info("GStreamer end of stream")
+
+    def get_buffer(self, h264_data):
+        size = len(h264_data)
+        if size <= self.POOL_BUFFER_SIZE:
+            ret, buf = self.buffer_pool.acquire_buffer(self.acquire_params)
+            if ret == Gst.FlowReturn.OK:
+                buf.fill(0, h264_data)
+                buf.set_size(size)
+                return buf
+        return Gst.Buffer.new_wrapped(h264_data)
 
     def push_data(self, h264_data):
-        buf = Gst.Buffer.new_wrapped(h264_data)
+        buf = self.get_buffer(h264_data)
         buf.set_flags(Gst.BufferFlags.DISCONT)  # If you detect gaps
-        ret = self.appsrc.emit("push-buffer", buf)
+        ret = self.appsrc.push_buffer(buf)
         if ret != Gst.FlowReturn.OK and ret != Gst.FlowReturn.FLUSHING:
             logging.error(f"Push failed: {ret}")
 
@@ -97,11 +201,14 @@ class VideoDecoder:
     def stop(self):
         if self.appsrc:
             try:
-                self.appsrc.emit("end-of-stream")
+                self.appsrc.end_of_stream()
             except:
                 pass
 
         if self.pipeline:
             self.pipeline.set_state(Gst.State.NULL)
 
+        if self.buffer_pool:
+            self.buffer_pool.set_active(False)
+
         logging.info("Decoder stopped")